@@ -49,6 +49,10 @@ class AbstractBloom:
     def add_bit(self, v):
         raise NotImplementedError
 
+    def add_many(self, l):
+        for o in l:
+            self.add(o)
+
     @property
     def count(self):
         """ Estimate number of items (n) in the set """
@@ -112,6 +116,26 @@ class IntArrayBloom(AbstractBloom):
         ofs = v % bpi
         self.value[idx] |= 1 << ofs
 
+    def add_many(self, l):
+        # Same as repeated add(), but with the bit handling inlined and
+        # attributes in locals; per-item method calls are what
+        # dominate the cost of add().
+        hasher = self.hasher
+        k = self.k
+        m = self.m
+        bpi = self.bits_per_int
+        value = self.value
+        set_bits = self.set_bits
+        for o in l:
+            hash_iterator = hasher(o)
+            for i in range(k):
+                (idx, ofs) = divmod(next(hash_iterator) % m, bpi)
+                bit = 1 << ofs
+                if not value[idx] & bit:
+                    value[idx] |= bit
+                    set_bits += 1
+        self.set_bits = set_bits
+
     def has_bit(self, v):
         bpi = self.bits_per_int
         idx = int(v // bpi)
@@ -59,10 +59,16 @@ class LeafNode(Node):
     def __repr__(self):
         return '<%s %s>' % (self.__class__.__name__, self.name)
 
+    @classmethod
+    def key_for_name(cls, name):
+        """Key of a leaf with the given name (without creating one)."""
+        if not cls.name_hash_size:
+            return name
+        return mmh3.hash_bytes(name)[:cls.name_hash_size] + name
+
     @lazy_property
     def key(self):
-        b = mmh3.hash_bytes(self.name)[:self.name_hash_size]
-        return b + self.name
+        return self.key_for_name(self.name)
 
     @lazy_property
     def size(self):
@@ -74,8 +80,8 @@ class TreeNode(Node):
 node. """
 
     maximum_size = const.BLOCK_SIZE_LIMIT
-    minimum_size = maximum_size * 1 / 4
-    has_spares_size = maximum_size / 2
+    minimum_size = maximum_size // 4
+    has_spares_size = maximum_size // 2
 
     key = None
 
@@ -109,6 +115,13 @@ node. """
             self.mark_dirty()
         return idx
 
+    def _child_key_index(self, k):
+        # child_keys is sorted, so this is O(log n) instead of .index()
+        child_keys = self.child_keys
+        idx = bisect.bisect_left(child_keys, k)
+        assert child_keys[idx] == k
+        return idx
+
     def _pop_child(self, idx, **kw):
         c = self.children[idx]
         self.remove_child_nocheck(c, idx=idx, **kw)
@@ -118,7 +131,7 @@ node. """
         assert isinstance(c, Node)
         self.csize -= c.size
         if idx is None:
-            idx = self.child_keys.index(c.key)
+            idx = self._child_key_index(c.key)
         del self.children[idx]
         del self.child_keys[idx]
         if not skip_dirty:
@@ -128,20 +141,22 @@ node. """
         nk = self.child_keys[0]
         if not self.parent or (not force and self.key <= nk):
             return
-        idx = self.parent.child_keys.index(self.key)
+        idx = self.parent._child_key_index(self.key)
         self.parent.child_keys[idx] = nk
         self.key = nk
         if not idx:
             self.parent._update_key_maybe()
 
     def add_child(self, c):
-        _debug('add_child %s', c)
+        if DEBUG:
+            _debug('add_child %s', c)
         idx = self.add_child_nocheck(c)
         if not idx:
             self._update_key_maybe()
         if self.csize <= self.maximum_size:
             return
-        _debug(' too big, splitting')
+        if DEBUG:
+            _debug(' too big, splitting')
         tn = self.create()
         while self.csize > tn.csize:
             tn.add_child_nocheck(self._pop_child(-1, skip_dirty=True),
@@ -162,11 +177,13 @@ node. """
         tn2.mark_dirty()
 
     def add_to_tree(self, c):
-        _debug('adding %s to %s', c, self)
+        if DEBUG:
+            _debug('adding %s to %s', c, self)
         sc = self.search_prev_or_eq(c)
         if sc:
             assert sc.key != c.key
-            _debug(' closest match: %s', sc)
+            if DEBUG:
+                _debug(' closest match: %s', sc)
             sc.parent.add_child(c)
             return
         self.add_child(c)
@@ -204,23 +221,28 @@ node. """
         return n
 
     def get_leaves(self):
-        for child in self.children:
-            if not isinstance(child, TreeNode):
+        # Explicit stack instead of nested generators per tree level
+        stack = [iter(self.children)]
+        while stack:
+            for child in stack[-1]:
+                if isinstance(child, TreeNode):
+                    stack.append(iter(child.children))
+                    break
                 yield child
             else:
-                yield from child.get_leaves()
+                stack.pop()
 
     def get_smaller_sib(self):
         if not self.parent:
             return
-        idx = self.parent.child_keys.index(self.key) - 1
+        idx = self.parent._child_key_index(self.key) - 1
         if idx >= 0:
             return self.parent.children[idx]
 
     def get_larger_sib(self):
         if not self.parent:
             return
-        idx = self.parent.child_keys.index(self.key) + 1
+        idx = self.parent._child_key_index(self.key) + 1
         if idx < len(self.parent.children):
             return self.parent.children[idx]
 
@@ -303,18 +325,22 @@ should be propagated upwards in the tree)."""
         # this is root so  no need to worry about .key handling..
 
     def search_prev_or_eq(self, c):
+        return self.search_prev_or_eq_key(c.key)
+
+    def search_prev_or_eq_key(self, k):
         if DEBUG:
-            _debug('search_prev_or_eq %s in %s', c, self)
+            _debug('search_prev_or_eq_key %s in %s', k, self)
         n = self
-        k = c.key
+        bisect_right = bisect.bisect_right
         while True:
-            if not n.child_keys:
+            child_keys = n.child_keys
+            if not child_keys:
                 if DEBUG:
                     _debug(' no children')
                 return
             if DEBUG:
-                _debug(' child_keys %s', n.child_keys)
-            idx = bisect.bisect_right(n.child_keys, k)
+                _debug(' child_keys %s', child_keys)
+            idx = bisect_right(child_keys, k)
             if idx:
                 idx -= 1
             if DEBUG:
@@ -326,6 +352,9 @@ should be propagated upwards in the tree)."""
                 return n
 
     def search(self, c):
-        sc = self.search_prev_or_eq(c)
-        if sc and sc.key == c.key:
+        return self.search_key(c.key)
+
+    def search_key(self, k):
+        sc = self.search_prev_or_eq_key(k)
+        if sc and sc.key == k:
             return sc
@@ -24,12 +24,19 @@ e.g. pybabel-like TLV magic format, or some other endecode library.
 """
 
 import base64
+import struct
 
 # base64 altchars to use; the default +/ is not good, as / is bad
 # within (non-path-containing) filenames. -_ is used in e.g. RFC4648
 # base64url.
 _altchars = b'-_'
 
+# padding to add to unpadded base64 data, by its length % 4
+_b64padding = (b'', b'===', b'==', b'=')
+
+_uint32 = struct.Struct('>I')
+_uint64 = struct.Struct('>Q')
+
 
 class Decoder:
 
@@ -42,7 +49,7 @@ class Decoder:
 
     def decode_base64url(self):
         b = self.decode_bytes_rest()
-        b += b'=' * (-len(b) % 4)
+        b += _b64padding[len(b) & 3]
         return base64.b64decode(b, altchars=_altchars, validate=True)
 
     def decode_bytes(self, n):
@@ -62,17 +69,17 @@ class Decoder:
         b = self.decode_bytes(1)
         return b[0]
 
+    def _decode_struct(self, st):
+        assert self._left() >= st.size
+        (v,) = st.unpack_from(self.b, self.ofs)
+        self.ofs += st.size
+        return v
+
     def decode_uint32(self):
-        b1 = self.decode_uint8()
-        b2 = self.decode_uint8()
-        b3 = self.decode_uint8()
-        b4 = self.decode_uint8()
-        return b1 << 24 | b2 << 16 | b3 << 8 | b4
+        return self._decode_struct(_uint32)
 
     def decode_uint64(self):
-        i1 = self.decode_uint32()
-        i2 = self.decode_uint32()
-        return i1 << 32 | i2
+        return self._decode_struct(_uint64)
 
     def decode_uint(self):
         v = 0
@@ -96,7 +103,7 @@ class Encoder:
         self.l = []
 
     def encode_base64url(self, b):
-        self.l.append(base64.b64encode(b, altchars=_altchars).rstrip(b'='))
+        self.l.append(base64.urlsafe_b64encode(b).rstrip(b'='))
         return self
 
     def encode_bytes(self, b):
@@ -114,15 +121,11 @@ class Encoder:
         return self
 
     def encode_uint32(self, v):
-        self.encode_uint8(v >> 24)
-        self.encode_uint8(v >> 16 & 0xff)
-        self.encode_uint8(v >> 8 & 0xff)
-        self.encode_uint8(v & 0xff)
+        self.l.append(_uint32.pack(v))
         return self
 
     def encode_uint64(self, v):
-        self.encode_uint32(v >> 32)
-        self.encode_uint32(v & 0xFFFFFFFF)
+        self.l.append(_uint64.pack(v))
         return self
 
     def encode_uint(self, v):
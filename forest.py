@@ -38,7 +38,7 @@ particular (file) inode.
 
 """
 
-import collections
+import contextlib
 import logging
 import stat
 import time
@@ -56,6 +56,28 @@ _debug = logging.getLogger(__name__).debug
 PRINT_DEBUG_FLUSH = True
 
 
+class _ReferenceSetDict(dict):
+    """defaultdict(weakref.WeakSet) equivalent, which recycles the
+    (empty) sets of deleted keys instead of creating new ones."""
+
+    pool_size = 1024
+
+    def __init__(self):
+        dict.__init__(self)
+        self.pool = []
+
+    def __missing__(self, key):
+        pool = self.pool
+        v = pool.pop() if pool else weakref.WeakSet()
+        self[key] = v
+        return v
+
+    def __delitem__(self, key):
+        v = self.pop(key)
+        if not v and len(self.pool) < self.pool_size:
+            self.pool.append(v)
+
+
 class Forest:
     """Forest maintains the (nested set of) trees.
 
@@ -81,8 +103,11 @@ class Forest:
             any_node_block_data_references_callback)
         self.init()
 
+    _batch_depth = 0
+    _batch_flushed = False
+
     def init(self):
-        self.block_id_references = collections.defaultdict(weakref.WeakSet)
+        self.block_id_references = _ReferenceSetDict()
         self.fds = Allocator()
         self.inodes = inode.INodeAllocator(self, self.root_inode)
         self.dirty_node_set = set()
@@ -132,7 +157,31 @@ class Forest:
         _debug('create_file %s 0x%x', name, mode)
         return self._create(mode, dir_inode, name)
 
+    @contextlib.contextmanager
+    def batch(self):
+        """Defer flush()es done within the block to its end.
+
+        Only single flush (and therefore storage flush and its
+        transaction) is done at the end, if any flush was requested
+        within the block. If the block raises, the deferred flush is
+        dropped (and the changes stay unflushed in memory)."""
+        self._batch_depth += 1
+        flush = False
+        try:
+            yield
+            flush = True
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                flush = flush and self._batch_flushed
+                self.__dict__.pop('_batch_flushed', None)
+        if flush:
+            self.flush()
+
     def flush(self):
+        if self._batch_depth:
+            self._batch_flushed = True
+            return
         if PRINT_DEBUG_FLUSH:
             print('flush')
             t = time.time()
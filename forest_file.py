@@ -279,7 +279,8 @@ class FileINode(util.DirtyMixin, inode.INode):
                 s = b''
             assert isinstance(s, bytes)
             bufmax = bufmax or len(buf)
-            ns = buf[bufofs:bufofs + bufmax]
+            # View, not copy; the formatting below copies it only once
+            ns = memoryview(buf)[bufofs:bufofs + bufmax]
             rofs = ofs + len(ns)
             _debug('_replace %d: %d/%d = %d', len(s), ofs, rofs, len(ns))
             topad = max(0, ofs - len(s))
@@ -24,7 +24,7 @@ import weakref
 
 import btree
 import const
-from util import CBORPickler, DataMixin, DirtyMixin, sha256
+from util import CBORPickler, DataMixin, DirtyMixin, blake2b
 
 _debug = logging.getLogger(__name__).debug
 
@@ -177,7 +177,7 @@ class LoadedTreeNode(BlockIdReferrerMixin, DirtyMixin, btree.TreeNode):
         for child in self.children:
             child.flush()
         data = self.to_data()
-        block_id = sha256(self.forest.storage.block_id_key, *data)
+        block_id = blake2b(self.forest.storage.block_id_key, *data)
         return self.set_block(block_id, data)
 
     @property
@@ -196,8 +196,7 @@ class LoadedTreeNode(BlockIdReferrerMixin, DirtyMixin, btree.TreeNode):
             self.add_child_nocheck(tn2, skip_dirty=True)
 
     def search_name(self, name):
-        n = self.leaf_class(self.forest, name=name)
-        return self.search(n)
+        return self.search_key(self.leaf_class.key_for_name(name))
 
     def set_block(self, block_id, data):
         if block_id == self.block_id:
@@ -349,6 +348,45 @@ class DirectoryTreeNode(LoadedTreeNode):
     leaf_class = DirectoryEntry
     entry_type = const.TYPE_DIRNODE
 
+    # Only used in (directory tree) root: name -> leaf node. Entries
+    # are removed when the leaf is removed from the tree, and the whole
+    # cache is dropped if any part of the tree is unloaded.
+    _name_cache = None
+
+    def remove_child_nocheck(self, c, **kw):
+        LoadedTreeNode.remove_child_nocheck(self, c, **kw)
+        if isinstance(c, btree.LeafNode):
+            cache = self.root._name_cache
+            if cache and cache.get(c.name) is c:
+                del cache[c.name]
+
+    def search_name(self, name):
+        if self.parent is not None:
+            return LoadedTreeNode.search_name(self, name)
+        cache = self._name_cache
+        if cache:
+            n = cache.get(name)
+            if n is not None:
+                return n
+        k = self.leaf_class.key_for_name(name)
+        sc = self.search_prev_or_eq_key(k)
+        if sc is None:
+            return
+        # The descent loaded the whole bottom-level node anyway; cache
+        # all of its leaves, not just the one that was asked for.
+        if cache is None:
+            cache = self._name_cache = {}
+        for c in sc.parent.children:
+            cache[c.name] = c
+        if sc.key == k:
+            return sc
+
+    def unload_if_possible(self, protected_set):
+        was_loaded = self._loaded
+        LoadedTreeNode.unload_if_possible(self, protected_set)
+        if was_loaded and not self._loaded:
+            self.root._name_cache = None
+
 
 class FileBlockEntry(NamedLeafNode):
     name_hash_size = 0
@@ -389,7 +427,7 @@ class FileData(DirtyMixin, BlockIdReferrerMixin):
     def perform_flush(self, *, in_inode=True):
         assert self.block_data is not None
         bd = (self.entry_type, self.block_data)
-        bid = sha256(self.forest.storage.block_id_key, *bd)
+        bid = blake2b(self.forest.storage.block_id_key, *bd)
         if self.block_id == bid:
             return
         self.forest.storage.refer_or_store_block(bid, bd)
@@ -30,17 +30,18 @@ import lz4.block
 import psutil
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
 import const
 import util
 from endecode import Decoder, Encoder
 from ms.lazy import lazy_property
-from util import getrecsizeof
 
 _debug = logging.getLogger(__name__).debug
 
+DEBUG = False  # Special flag which absolutely turns off logging here
+
 
 class BlockCodec:
     """This is a class which handles the raw encode-decode of block
@@ -53,6 +54,17 @@ compression+encryption."""
     def decode_block(self, block_id, block_data):
         raise NotImplementedError
 
+    def encode_typed_block(self, block_id, t, d):
+        """Encode data d with (one byte) type t.
+
+        By default, the type is simply prepended to the data."""
+        return self.encode_block(block_id, bytes([t]) + d)
+
+    def decode_typed_block(self, block_id, block_data):
+        rd = self.decode_block(block_id, block_data)
+        assert len(rd) > 0
+        return (rd[0], rd[1:])
+
 
 class NopBlockCodec(BlockCodec):
 
@@ -68,8 +80,15 @@ class NopBlockCodec(BlockCodec):
 class ConfidentialBlockCodec(BlockCodec):
     """Real class which implements the (outer layer) of block codec
 stuff, which provides for confidentiality and authentication of the
-data within.."""
+data within..
+
+    Typed blocks (see encode_typed_block) have different magic, and
+    their type is stored in the clear in the header; it is
+    authenticated as part of the additional data along with the block
+    id. Their layout also matches what AESGCM produces (tag at the end).
+    """
     magic = b'4207'
+    typed_magic = b'4208'
     block_id_len = 32
     iv_len = 16
     tag_len = 16
@@ -83,6 +102,7 @@ data within.."""
                          iterations=100000,
                          backend=self.backend)
         self.key = kdf.derive(password)
+        self.aesgcm = AESGCM(self.key)  # expanded key is kept within
 
     @property
     def block_id_key(self):
@@ -95,14 +115,9 @@ data within.."""
         enc.encode_bytes(self.magic)
         iv = os.urandom(self.iv_len)
         enc.encode_bytes(iv)
-        c = Cipher(algorithms.AES(self.key), modes.GCM(iv),
-                   backend=self.backend)
-        e = c.encryptor()
-        e.authenticate_additional_data(block_id)
-        s = e.update(block_data) + e.finalize()
-        assert len(e.tag) == self.tag_len
-        enc.encode_bytes(e.tag)
-        enc.encode_bytes(s)
+        s = memoryview(self.aesgcm.encrypt(iv, block_data, block_id))
+        enc.encode_bytes(s[-self.tag_len:])
+        enc.encode_bytes(s[:-self.tag_len])
         return enc.value
 
     def decode_block(self, block_id, block_data):
@@ -122,13 +137,34 @@ data within.."""
         # get tag
         tag = dec.decode_bytes(self.tag_len)
 
-        c = Cipher(algorithms.AES(self.key), modes.GCM(iv, tag),
-                   backend=self.backend)
-        d = c.decryptor()
-        d.authenticate_additional_data(block_id)
+        return self.aesgcm.decrypt(iv, dec.decode_bytes_rest() + tag,
+                                   block_id)
+
+    def encode_typed_block(self, block_id, t, d):
+        assert (isinstance(block_id, bytes)
+                and len(block_id) == self.block_id_len)
+        tb = bytes([t])
+        iv = os.urandom(self.iv_len)
+        # single join of header + ciphertext (+ tag)
+        return b''.join((self.typed_magic, tb, iv,
+                         self.aesgcm.encrypt(iv, d, block_id + tb)))
+
+    def decode_typed_block(self, block_id, block_data):
+        assert isinstance(block_data, bytes)
+        if not block_data.startswith(self.typed_magic):
+            # Older format with the type within the encrypted data
+            return BlockCodec.decode_typed_block(self, block_id, block_data)
+        assert (isinstance(block_id, bytes)
+                and len(block_id) == self.block_id_len)
+        assert len(block_data) >= (len(self.typed_magic) + 1 + self.iv_len +
+                                   self.tag_len)
 
-        s = d.update(dec.decode_bytes_rest()) + d.finalize()
-        return s
+        ofs = len(self.typed_magic)
+        tb = block_data[ofs:ofs + 1]
+        ofs += 1
+        iv = block_data[ofs:ofs + self.iv_len]
+        s = memoryview(block_data)[ofs + self.iv_len:]
+        return (tb[0], self.aesgcm.decrypt(iv, s, block_id + tb))
 
 
 class TypedBlockCodec(BlockCodec):
@@ -144,14 +180,24 @@ class TypedBlockCodec(BlockCodec):
         (t, d) = block_data
         assert isinstance(t, int) and t >= 0 and t < 256  # just one byte
         assert isinstance(d, bytes)
-        return self.codec.encode_block(block_id, bytes([t]) + d)
+        return self.codec.encode_typed_block(block_id, t, d)
 
     def decode_block(self, block_id, block_data):
         assert isinstance(block_data, bytes)
         assert len(block_data) > 0
-        rd = self.codec.decode_block(block_id, block_data)
-        assert len(rd) > 0
-        return (rd[0], rd[1:])
+        return self.codec.decode_typed_block(block_id, block_data)
+
+
+def _is_compressible(d, *, sample_size=512, max_unique=192):
+    """Cheap guess of whether d is worth compressing.
+
+    Roughly evenly spaced sample of the data is taken, and if (nearly)
+    all byte values occur in it, the data is probably already
+    compressed or encrypted."""
+    if len(d) < sample_size:
+        return True
+    sample = d[::len(d) // sample_size]
+    return len(set(sample)) < max_unique
 
 
 class CompressingTypedBlockCodec(TypedBlockCodec):
@@ -159,6 +205,8 @@ class CompressingTypedBlockCodec(TypedBlockCodec):
     def encode_block(self, block_id, block_data):
         (t, d) = block_data
         assert not (t & const.BIT_COMPRESSED)
+        if not _is_compressible(d):
+            return TypedBlockCodec.encode_block(self, block_id, (t, d))
         cd = lz4.block.compress(d)
         if len(cd) < len(d):
             t = t | const.BIT_COMPRESSED
@@ -194,20 +242,29 @@ class StoredBlock(util.DirtyMixin):
     - refcnt changes
     - type may change
 
+    Backends may provide the data in its encoded form only
+    (encoded_data); it is decoded using the backend codec only when the
+    data is actually needed. Refcnt-only changes therefore never decode
+    (or re-encode) the block.
     """
 
     stored = None  # stored version of the block
 
     t = 0  # for LRU use, in cache
 
-    def __init__(self, parent, id, *, refcnt=None, data=None, type=None):
+    _data = None
+    encoded_data = None  # data as encoded by backend codec, if any
+
+    def __init__(self, parent, id, *, refcnt=None, data=None, type=None,
+                 encoded_data=None):
         assert isinstance(parent, Storage)
         self.parent = parent
         self.id = id
         # ^ should be immutable
 
         self.refcnt = refcnt
-        self.data = data
+        self._data = data
+        self.encoded_data = encoded_data
         self.type = type
         # ^ should have accessors for mutation
 
@@ -215,35 +272,73 @@ class StoredBlock(util.DirtyMixin):
         return '<%s %s %s refcnt:%s type:%s datalen:%s>' % (self.__class__.__name__, id(self),
                                                             self.id, self.refcnt,
                                                             self.type,
-                                                            len(self.data or ''))
+                                                            len(self._data or ''))
 
     @property
     def cache_size(self):
-        return util.getrecsizeof(self.data) if self.data else 0
+        size = util.getrecsizeof(self._data) if self._data else 0
+        if self.encoded_data:
+            size += len(self.encoded_data)
+        return size
+
+    @property
+    def data(self):
+        data = self._data
+        if data is None and self.encoded_data is not None:
+            old_cache_size = self.cache_size
+            data = self.parent.backend.codec.decode_block(self.id,
+                                                          self.encoded_data)
+            self._data = data
+            self.parent.updated_block_cache_size(self, old_cache_size)
+        return data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self.encoded_data = None
+
+    @property
+    def has_data(self):
+        return bool(self._data or self.encoded_data)
+
+    def encode_data(self, codec):
+        """Get data encoded with the (backend) codec.
+
+        The result is retained until the data changes, so subsequent
+        flushes of e.g. refcnt changes do not encode it again."""
+        if self.encoded_data is None:
+            old_cache_size = self.cache_size
+            self.encoded_data = codec.encode_block(self.id, self._data)
+            self.parent.updated_block_cache_size(self, old_cache_size)
+        return self.encoded_data
 
     def mark_dirty_related(self):
         assert self.stored is None
         self.stored = StoredBlock(self.parent, self.id, refcnt=self.refcnt,
-                                  data=self.data, type=self.type)
+                                  data=self._data, type=self.type,
+                                  encoded_data=self.encoded_data)
         self.parent.mark_block_dirty(self)
 
     def perform_flush(self):
         assert isinstance(self.parent, Storage)
-        ops = 0
-        if self.stored.refcnt is None:
-            if self.refcnt:
+        parent = self.parent
+        stored = self.stored
+        # Common case first: the block is already stored on disk, and
+        # we just update it there.
+        if stored.refcnt is not None:
+            if DEBUG:
+                _debug(' %s changed on disk', self)
+            parent.updated_block_type(self, stored.type, self.type)
+            ops = parent.flush_block_be(self)
+        elif self.refcnt:
+            if DEBUG:
                 _debug(' added to storage due to nonzero new refcnt')
-                self.parent.backend.store_block(self)
-                ops += 1
-            else:
-                # don't even remove self.stored - it retains the fact
-                # this is not persisted to disk
-                ops += self.parent.flush_block_be(self)
+            parent.backend.store_block(self)
+            ops = 1
         else:
-            _debug(' %s changed on disk', self)
-            # It is stored on disk. Update it there.
-            self.parent.updated_block_type(self, self.stored.type, self.type)
-            ops += self.parent.flush_block_be(self)
+            # don't even remove self.stored - it retains the fact
+            # this is not persisted to disk
+            ops = parent.flush_block_be(self)
         del self.stored
         return ops
 
@@ -269,10 +364,28 @@ class StorageBackend:
     demand.
     """
 
+    _cache = None  # name -> (expiration time, value)
+
     @property
     def block_id_key(self):
         return b''
 
+    def _get_cached(self, name, fun, *, max_age=1):
+        """Get (and cache) result of fun for max_age seconds, or until
+        flush_done. This is for e.g. filesystem statistics that may be
+        polled often."""
+        now = time.monotonic()
+        cache = self._cache
+        if cache is None:
+            cache = self._cache = {}
+        else:
+            o = cache.get(name)
+            if o is not None and o[0] > now:
+                return o[1]
+        v = fun()
+        cache[name] = (now + max_age, v)
+        return v
+
     def delete_block(self, block):
         """Delete the block in storage.
 
@@ -284,7 +397,7 @@ class StorageBackend:
         raise NotImplementedError
 
     def flush_done(self):
-        pass
+        self._cache = None
 
     def get_block_by_id(self, storage, block_id):
         """Get data for the block identified by block_id.
@@ -294,6 +407,17 @@ class StorageBackend:
         """
         raise NotImplementedError
 
+    def get_blocks_by_ids(self, storage, block_ids):
+        """Get StoredBlock instances for the given block_ids.
+
+        Blocks that do not exist are omitted. Backends may override
+        this to do the lookups in some more efficient (batched) way.
+        """
+        for block_id in block_ids:
+            b = self.get_block_by_id(storage, block_id)
+            if b is not None:
+                yield b
+
     def get_block_id_by_name(self, n):
         """Get the block identifier for the named block.
 
@@ -325,22 +449,43 @@ class StorageBackend:
 
 
 class DictStorageBackend(StorageBackend):
-    """ For testing purposes, in-memory dict-based storage backend. """
+    """ For testing purposes, in-memory dict-based storage backend.
+
+    Blocks are stored as plain (refcnt, type, data, size) tuples, and
+    StoredBlock instances are created only when they are requested.
+    """
 
     def __init__(self):
         self.name2bid = {}
         self.bid2block = {}
+        self.bytes_used = 0  # approximation, maintained on changes
+
+    def _set_block(self, block):
+        data = block.data
+        # typed block data is (type, bytes) tuple
+        size = len(block.id) + len((data[1] if isinstance(data, tuple)
+                                    else data) or b'')
+        old = self.bid2block.get(block.id)
+        self.bytes_used += size - (old[3] if old else 0)
+        self.bid2block[block.id] = (block.refcnt, block.type, data, size)
 
     def delete_block(self, block):
-        _debug('delete_block %s', block)
-        del self.bid2block[block.id]
+        if DEBUG:
+            _debug('delete_block %s', block)
+        self.bytes_used -= self.bid2block.pop(block.id)[3]
 
     def flush_block(self, block):
-        # nop, it is already reflected in the block
+        if block.id in self.bid2block:
+            self._set_block(block)
         return 1
 
     def get_block_by_id(self, storage, block_id):
-        return self.bid2block.get(block_id)
+        r = self.bid2block.get(block_id)
+        if r is None:
+            return
+        (refcnt, type, data, _) = r
+        return StoredBlock(storage, block_id, refcnt=refcnt, data=data,
+                           type=type)
 
     def get_block_id_by_name(self, n):
         return self.name2bid.get(n)
@@ -349,9 +494,7 @@ class DictStorageBackend(StorageBackend):
         return psutil.virtual_memory().available
 
     def get_bytes_used(self):
-        seen = set()
-        return getrecsizeof(self.name2bid, seen) + \
-            getrecsizeof(self.bid2block, seen)
+        return self.bytes_used
 
     def set_block_name(self, block_id, n):
         if block_id:
@@ -361,7 +504,7 @@ class DictStorageBackend(StorageBackend):
 
     def store_block(self, block):
         assert block.id not in self.bid2block
-        self.bid2block[block.id] = block
+        self._set_block(block)
 
 
 class Storage:
@@ -406,12 +549,14 @@ class Storage:
         exist, this function will be eventually called by later flush
         methods until they do not exist.
         """
-        _debug('delete_block_if_no_extref %s', block)
+        if DEBUG:
+            _debug('delete_block_if_no_extref %s', block)
         if self.block_id_has_references_callback(block.id):
             if not self.referenced_refcnt0_blocks:
                 self.referenced_refcnt0_blocks = {}
             self.referenced_refcnt0_blocks[block.id] = block
-            _debug(' .. externally referred, omitting for now')
+            if DEBUG:
+                _debug(' .. externally referred, omitting for now')
             return
         if self.referenced_refcnt0_blocks:
             self.referenced_refcnt0_blocks.pop(block.id, None)
@@ -420,7 +565,8 @@ class Storage:
     def delete_block_with_deps(self, block):
         """Delete block id and remove its references."""
         assert isinstance(block, StoredBlock)
-        _debug('delete_block_with_deps %s', block)
+        if DEBUG:
+            _debug('delete_block_with_deps %s', block)
         self.update_block_data_dependencies(block.data, False, block.type)
         self.delete_block_be(block)
         return True
@@ -430,7 +576,8 @@ class Storage:
 
     def flush(self):
         """ Attempt to get rid of dangling reference count 0 blocks. """
-        _debug('Storage.flush')
+        if DEBUG:
+            _debug('Storage.flush')
         ops = 0
         while True:
             s = self.referenced_refcnt0_blocks
@@ -439,7 +586,8 @@ class Storage:
             del self.referenced_refcnt0_blocks
             deleted = False
             for block in s.values():
-                _debug('flush dangling %s', block)
+                if DEBUG:
+                    _debug('flush dangling %s', block)
                 if not block.refcnt:
                     if self.delete_block_if_no_extref(block):
                         ops += 1
@@ -454,49 +602,56 @@ class Storage:
         return self.backend.flush_block(block)
 
     def flush_dirty_store_blocks(self):
-        _debug('Storage.flush_dirty_store_blocks')
+        if DEBUG:
+            _debug('Storage.flush_dirty_store_blocks')
         ops = 0
-        while self._dirty_bid2block:
-            blocks = list(self._dirty_bid2block.values())
-            self._dirty_bid2block.clear()
+        dirty = self._dirty_bid2block
+        while dirty:
+            blocks = list(dirty.values())
+            dirty.clear()
             nonzero_blocks = []
-            # initially handle refcnt = 0 cases
+            nonzero_append = nonzero_blocks.append
+            # initially handle refcnt = 0 cases; most dirty blocks are
+            # mere refcnt changes of live blocks, so check that first
             for block in blocks:
                 assert block.dirty
-                if not block.refcnt:
-                    ops += block.flush()
+                if block.refcnt:
+                    nonzero_append(block)
                 else:
-                    nonzero_blocks.append(block)
+                    ops += block.flush()
 
             for block in nonzero_blocks:
-                if block.refcnt:
-                    if block.id not in self._dirty_bid2block:
-                        ops += block.flush()
-                else:
-                    self._dirty_bid2block[block.id] = block
+                if not block.refcnt:
+                    dirty[block.id] = block
                     # populate for subsequent run
+                elif block.id not in dirty:
+                    ops += block.flush()
         return ops
 
     def get_block_data_references(self, block_data):
         yield from self.block_data_references_callback(block_data)
 
     def get_block_by_id(self, block_id):
-        _debug('get_block_by_id %s', block_id)
+        if DEBUG:
+            _debug('get_block_by_id %s', block_id)
         block = self._dirty_bid2block.get(block_id)
         if block and (block.refcnt or
                       self.block_id_has_references_callback(block_id)):
-            _debug(' found in _dirty_bid2block: %s (%d refcnt)',
-                   block, block.refcnt)
+            if DEBUG:
+                _debug(' found in _dirty_bid2block: %s (%d refcnt)',
+                       block, block.refcnt)
             return block
         d = self.referenced_refcnt0_blocks
         if d:
             block = d.get(block_id)
             if block and (block.refcnt or
                           self.block_id_has_references_callback(block_id)):
-                _debug(' found in referenced_refcnt0_blocks: %s (%d refcnt)',
-                       block, block.refcnt)
+                if DEBUG:
+                    _debug(' found in referenced_refcnt0_blocks: %s'
+                           ' (%d refcnt)', block, block.refcnt)
                 return block
-        _debug('falling back to storage')
+        if DEBUG:
+            _debug('falling back to storage')
         return self.backend.get_block_by_id(self, block_id)
 
     def get_block_data_by_id(self, block_id):
@@ -568,7 +723,13 @@ layer."""
             for block_id in bids:
                 self.release_block(block_id)
 
+    def updated_block_cache_size(self, block, old_cache_size):
+        pass
+
     def updated_block_type(self, block, old_type, new_type):
+        if old_type == new_type:
+            # Dependencies stay the same (and data need not be decoded)
+            return
         # Only cases in which it is valid not to have data; all other state
         # transitions should end with us having data
         if new_type == const.BLOCK_TYPE_MISSING:
@@ -610,9 +771,11 @@ class DelayedStorage(Storage):
             r = Storage.get_block_by_id(self, block_id)
             if r is None:
                 r = StoredBlock(self, block_id)
-                _debug('_goc_block_by_id added %s', r)
+                if DEBUG:
+                    _debug('_goc_block_by_id added %s', r)
             else:
-                _debug('_goc_block_by_id loaded %s', r)
+                if DEBUG:
+                    _debug('_goc_block_by_id loaded %s', r)
             self.cache_size += r.cache_size
             self._cache_bid2block[block_id] = r
         r.t = time.time()
@@ -625,6 +788,10 @@ class DelayedStorage(Storage):
             v += b.cache_size
         return v
 
+    def updated_block_cache_size(self, block, old_cache_size):
+        if self._cache_bid2block.get(block.id) is block:
+            self.cache_size += block.cache_size - old_cache_size
+
     def _flush_names(self):
         ops = 0
         for block_name, o in self._names.items():
@@ -638,7 +805,8 @@ class DelayedStorage(Storage):
     def _shrink_cache(self):
         l = list(self._cache_bid2block.values())
         goal = self.maximum_cache_size * 3 // 4
-        _debug('_shrink_cache goal=%d < %d', goal, self.cache_size)
+        if DEBUG:
+            _debug('_shrink_cache goal=%d < %d', goal, self.cache_size)
         # try to stay within [3/4 * max, max]
         l.sort(key=lambda k: k.t)  # last used time
         while l and self.cache_size > goal:
@@ -646,7 +814,8 @@ class DelayedStorage(Storage):
             self._delete_cached_block(block)
 
     def _delete_cached_block(self, block):
-        _debug('_delete_cached_block %s', block)
+        if DEBUG:
+            _debug('_delete_cached_block %s', block)
         assert isinstance(block, StoredBlock)
         block2 = self._cache_bid2block.pop(block.id)
         assert block is block2, '%s != %s' % (block, block2)
@@ -661,7 +830,8 @@ class DelayedStorage(Storage):
         self._delete_cached_block(block)
 
     def flush(self):
-        _debug('flush')
+        if DEBUG:
+            _debug('flush')
         ops = 0
         ops += self._flush_names()
         ops += Storage.flush(self)
@@ -679,11 +849,14 @@ class DelayedStorage(Storage):
         return self.backend.flush_block(block)
 
     def get_block_by_id(self, block_id):
-        _debug('%s.get_block_by_id %s', self.__class__.__name__, block_id)
+        if DEBUG:
+            _debug('%s.get_block_by_id %s', self.__class__.__name__, block_id)
         r = self._goc_block_by_id(block_id)
-        _debug(' => %s', r)
+        if DEBUG:
+            _debug(' => %s', r)
         if not r.refcnt and not self.block_id_has_references_callback(block_id):
-            _debug(' [skip - no refcnt, not referred]')
+            if DEBUG:
+                _debug(' [skip - no refcnt, not referred]')
             return
         return r
 
@@ -713,7 +886,8 @@ class DelayedStorage(Storage):
         return True
 
     def store_block(self, block_id, block_data, *, refcnt=1, type=const.BLOCK_TYPE_NORMAL):
-        _debug('store_block %s', block_id)
+        if DEBUG:
+            _debug('store_block %s', block_id)
         assert isinstance(block_id, bytes)
         assert block_data
         block = self._goc_block_by_id(block_id)
@@ -19,11 +19,14 @@ does not really help much here anyway.
 
 """
 
+import bisect
 import logging
+import os
+import struct
 import sys
 import tempfile
 
-import cbor
+import cbor2
 import lmdb
 import psutil
 
@@ -31,6 +34,24 @@ import storage
 
 _debug = logging.getLogger(__name__).debug
 
+DEBUG = False  # Special flag which absolutely turns off logging here
+
+# Block record is header + encoded block data. Records used to be
+# CBOR-encoded [data, refcnt, type] lists; those are still readable.
+_record_header = struct.Struct('<BIB')  # version, refcnt, type
+_record_version = 1
+_record_cbor_byte = 0x83  # CBOR 3-item array
+
+
+def _decode_record(r):
+    if not r:
+        return
+    if r[0] == _record_cbor_byte:
+        return cbor2.loads(r)
+    (version, refcnt, type) = _record_header.unpack_from(r)
+    assert version == _record_version
+    return (bytes(r[_record_header.size:]), refcnt, type)
+
 
 class LMDBStorageBackend(storage.StorageBackend):
     """LMDB storage backend.
@@ -40,80 +61,198 @@ class LMDBStorageBackend(storage.StorageBackend):
 
     TBD: using prdb code for this would have been 'nice' but I rather not
     mix the two hobby projects for now..
+
+    Block writes are not done immediately; instead, they are collected
+    and written within single write transaction in flush_done.
+
+    The database is ACI but no D (no sync). Temporary databases (no
+    filename given) also use writemap, in which case stray writes to
+    the map could corrupt the database; as it is gone at exit anyway,
+    the avoided write() calls are worth it.
     """
 
+    map_size = 1 << 40
+
     def __init__(self, *, codec=None, filename=None, **kw):
-        if filename is None:
+        is_temp = filename is None
+        if is_temp:
             self.tempdir = tempfile.TemporaryDirectory()
             filename = self.tempdir.name
         self.filename = filename
         self.codec = codec or storage.NopBlockCodec()
+        # readahead only pollutes page cache if the database does not
+        # fit in memory; map_size is just address space reservation, so
+        # look at the actual data file size (at open time)
+        data_path = os.path.join(filename, 'data.mdb')
+        data_size = os.path.exists(data_path) and os.path.getsize(data_path)
+        readahead = data_size < psutil.virtual_memory().total
         self.env = lmdb.open(self.filename, max_dbs=3,
                              metasync=False,  # system crash may undo last committed transaction
-                             sync=False, writemap=False,  # ACI but no D
-                             map_size=1 << 40,
+                             sync=False,  # ACI but no D
+                             writemap=is_temp, map_async=is_temp,
+                             readahead=readahead,
+                             map_size=self.map_size,
                              )
         self.name_db = self.env.open_db(b'name2id')
         self.block_db = self.env.open_db(b'id2block')
+        self._pending = {}  # block id -> record to write (None = delete)
+        self._pending_new = set()  # block ids which must not exist yet
 
     @property
     def block_id_key(self):
         return self.codec.block_id_key
 
     def delete_block(self, block):
-        _debug('delete_block %s', block)
-        with self.env.begin(db=self.block_db, write=True) as t:
-            t.delete(block.id)
+        if DEBUG:
+            _debug('delete_block %s', block)
+        self._pending[block.id] = None
+        self._pending_new.discard(block.id)
 
-    def flush_block(self, block):
+    def _encode_record(self, block):
         block_data = b''
-        if block.data is not None:
-            block_data = self.codec.encode_block(block.id, block.data)
+        if block.has_data or block.data is not None:
+            block_data = block.encode_data(self.codec)
         assert isinstance(block_data, bytes)
-        data = cbor.dumps([block_data, block.refcnt, block.type])
-        with self.env.begin(db=self.block_db, write=True) as t:
-            if t.get(block.id) == data:
-                return 0
-            t.put(block.id, data)
-            return 1
+        return _record_header.pack(_record_version, block.refcnt,
+                                   block.type) + block_data
+
+    def flush_block(self, block):
+        if block.id in self._pending and self._pending[block.id] is None:
+            return 0  # deleted; do not resurrect it
+        data = self._encode_record(block)
+        if self._with_record(block.id, lambda r: r == data):
+            return 0
+        self._pending[block.id] = data
+        return 1
 
     def flush_done(self):
+        pending = self._pending
+        if pending:
+            self._pending = {}
+            new = self._pending_new
+            self._pending_new = set()
+            puts = []
+            new_puts = []
+            with self.env.begin(db=self.block_db, write=True) as t:
+                # Sorted keys make for more sequential b-tree updates
+                for k, v in sorted(pending.items()):
+                    if v is None:
+                        t.delete(k)
+                    elif k in new:
+                        new_puts.append((k, v))
+                    else:
+                        puts.append((k, v))
+                with t.cursor() as c:
+                    if new_puts:
+                        added = self._put_sorted(c, new_puts, overwrite=False)
+                        assert added == len(new_puts), 'stored existing block'
+                    if puts:
+                        self._put_sorted(c, puts)
         self.env.sync()
+        storage.StorageBackend.flush_done(self)
+
+    def _put_sorted(self, c, items, **kw):
+        """Put sorted (key, value) items using cursor c, and return
+        the number of items added.
+
+        Items with keys greater than the current last key are appended
+        to the end of the database, which avoids the b-tree search per
+        item (e.g. when bulk loading into an empty database)."""
+        i = 0
+        if c.last():
+            last = c.key()
+            i = bisect.bisect_left(items, (last, ))
+            if i < len(items) and items[i][0] == last:
+                i += 1
+        added = 0
+        if i:
+            added += c.putmulti(items[:i], **kw)[1]
+        if i < len(items):
+            added += c.putmulti(items[i:], append=True, **kw)[1]
+        return added
+
+    def _with_record(self, block_id, fun):
+        """Call fun with the current record of block_id (None if not
+        present), and return its result.
+
+        The record may be a memoryview of the LMDB map, which is valid
+        only within the call; this way there is no copy of the whole
+        record made for reading it."""
+        if block_id in self._pending:
+            return fun(self._pending[block_id])
+        with self.env.begin(db=self.block_db, buffers=True) as t:
+            return fun(t.get(block_id))
 
     def get_block_by_id(self, st, block_id):
-        _debug('get_block_by_id %s', block_id)
+        if DEBUG:
+            _debug('get_block_by_id %s', block_id)
         if not block_id:
             return
-        with self.env.begin(db=self.block_db) as t:
-            r = t.get(block_id)
-            if not r:
-                return
-            r = cbor.loads(r)
+        r = self._with_record(block_id, _decode_record)
+        if not r:
+            return
+        return self._record_to_block(st, block_id, r)
+
+    def _record_to_block(self, st, block_id, r):
         block_data, block_refcnt, block_type = r
         assert isinstance(block_data, bytes)
         assert isinstance(block_refcnt, int)
-        block_data = block_data or None
-        block_data = self.codec.decode_block(block_id, block_data)
-        b = storage.StoredBlock(st, block_id, refcnt=block_refcnt, data=block_data,
-                                type=block_type)
+        b = storage.StoredBlock(st, block_id, refcnt=block_refcnt,
+                                type=block_type,
+                                encoded_data=block_data or None)
         return b
 
+    def get_blocks_by_ids(self, st, block_ids):
+        """Get blocks within single read transaction, in key order, so
+        that adjacent ids hit the same pages."""
+        pending = self._pending
+        todo = []
+        for block_id in block_ids:
+            if not block_id:
+                continue
+            if block_id in pending:
+                r = _decode_record(pending[block_id])
+                if r:
+                    yield self._record_to_block(st, block_id, r)
+                continue
+            todo.append(block_id)
+        if not todo:
+            return
+        todo.sort()
+        blocks = []
+        with self.env.begin(db=self.block_db, buffers=True) as t:
+            cur = t.cursor()
+            for block_id in todo:
+                if cur.set_key(block_id):
+                    r = _decode_record(cur.value())
+                    blocks.append(self._record_to_block(st, block_id, r))
+        yield from blocks
+
     def get_block_id_by_name(self, n):
-        _debug('get_block_id_by_name %s', n)
+        if DEBUG:
+            _debug('get_block_id_by_name %s', n)
         with self.env.begin(db=self.name_db) as t:
             return t.get(n)
 
     def get_bytes_available(self):
+        return self._get_cached('bytes_available',
+                                self._get_bytes_available)
+
+    def _get_bytes_available(self):
         if self.filename == ':memory:':
             return psutil.virtual_memory().available
         return psutil.disk_usage(self.filename).free
 
     def get_bytes_used(self):
+        return self._get_cached('bytes_used', self._get_bytes_used)
+
+    def _get_bytes_used(self):
         st = self.env.stat()
         return st['psize'] * (st['branch_pages'] + st['leaf_pages'] + st['overflow_pages'])
 
     def set_block_name(self, block_id, n):
-        _debug('set_block_name_raw %s %s', block_id, n)
+        if DEBUG:
+            _debug('set_block_name_raw %s %s', block_id, n)
         assert n
         with self.env.begin(db=self.name_db, write=True) as t:
             if block_id:
@@ -122,9 +261,14 @@ class LMDBStorageBackend(storage.StorageBackend):
                 t.delete(n)
 
     def store_block(self, block):
-        _debug('store_block %s', block)
-        assert self.get_block_by_id(block.parent, block.id) is None
-        self.flush_block(block)
+        if DEBUG:
+            _debug('store_block %s', block)
+        # Existence is checked when writing the block in flush_done
+        if block.id in self._pending:
+            assert self._pending[block.id] is None
+        else:
+            self._pending_new.add(block.id)
+        self._pending[block.id] = self._encode_record(block)
 
 
 class LMDBStorage(storage.Storage):
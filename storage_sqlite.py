@@ -29,6 +29,8 @@ import storage
 
 _debug = logging.getLogger(__name__).debug
 
+DEBUG = False  # Special flag which absolutely turns off logging here
+
 
 class SQLiteStorageBackend(storage.StorageBackend):
     """SQLite storage backend.
@@ -38,34 +40,71 @@ class SQLiteStorageBackend(storage.StorageBackend):
 
     TBD: using prdb code for this would have been 'nice' but I rather not
     mix the two hobby projects for now..
+
+    Block writes are collected, and written using single statement
+    (executemany) in flush_done.
     """
 
-    def __init__(self, *, codec=None, filename=':memory:', **kw):
+    _insert_sql = ('INSERT INTO blocks (id, data, refcnt, type) '
+                   'VALUES (?, ?, ?, ?)')
+
+    # NULL data in the upsert means 'data has not changed'
+    _upsert_sql = (_insert_sql + ' '
+                   'ON CONFLICT(id) DO UPDATE SET '
+                   'data=coalesce(excluded.data, blocks.data), '
+                   'refcnt=excluded.refcnt, type=excluded.type')
+
+    _index_sql = 'CREATE INDEX IF NOT EXISTS block_type ON blocks (type);'
+
+    # With at least this many new blocks in a flush, the secondary
+    # index is dropped for the inserts and rebuilt once afterwards
+    bulk_insert_size = 10000
+
+    # Extra pragmas per pragma_profile. 'bench' trades durability for
+    # speed (and memory): in WAL mode with synchronous=NORMAL, commits
+    # are not fsynced, so a power loss or OS crash may lose the latest
+    # transactions (but not corrupt the database) - ACI but no D,
+    # similar to the LMDB backend
+    pragma_profiles = {
+        'bench': ['PRAGMA journal_mode=WAL;',
+                  'PRAGMA synchronous=NORMAL;',
+                  'PRAGMA temp_store=MEMORY;',
+                  'PRAGMA mmap_size=10737418240;',
+                  'PRAGMA cache_size=-65536;',
+                  'PRAGMA fullfsync=false;'],
+    }
+
+    def __init__(self, *, codec=None, filename=':memory:',
+                 pragma_profile=None, **kw):
         self.filename = filename
         self.codec = codec or storage.NopBlockCodec()
+        # sqlite3's default statement cache (128, keyed by SQL text) is
+        # plenty; all statements here are constant strings, so they are
+        # parsed only once per connection.
         self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self._pending = {}  # block id -> upsert parameters (None = delete)
+        self._pending_new = set()  # block ids which must not exist yet
+        if pragma_profile:
+            for q in self.pragma_profiles[pragma_profile]:
+                self._get_execute_result(q)
         self._get_execute_result(
             'CREATE TABLE IF NOT EXISTS blocks(id PRIMARY KEY, data, refcnt, type);')
-        self._get_execute_result(
-            'CREATE INDEX IF NOT EXISTS block_type ON blocks (type);')
+        self._get_execute_result(self._index_sql)
         self._get_execute_result(
             'CREATE TABLE IF NOT EXISTS blocknames (name PRIMARY KEY, id);')
 
     def _get_execute_result(self, q, a=None, ignore_errors=False):
-        _debug('_get_execute_result %s %s', q, a)
-        c = self.conn.cursor()
+        if DEBUG:
+            _debug('_get_execute_result %s %s', q, a)
         try:
-            if a:
-                c.execute(q, a)
-            else:
-                c.execute(q)
+            r = self.conn.execute(q, a or ()).fetchall()
         except:
             if ignore_errors:
                 return
             else:
                 raise
-        r = c.fetchall()
-        _debug(' => %s', r)
+        if DEBUG:
+            _debug(' => %s', r)
         return r
 
     @property
@@ -73,94 +112,131 @@ class SQLiteStorageBackend(storage.StorageBackend):
         return self.codec.block_id_key
 
     def delete_block(self, block):
-        _debug('delete_block %s', block)
-        self._get_execute_result(
-            'DELETE FROM blocks WHERE id=?', (block.id,))
-
-    def _get_changed_block_fields(self, block):
-        prev_block = block.stored
-        if not prev_block or (not block.data) != (not prev_block.data):
-            data = block.data
-            if not data:
-                data = b''
-            else:
-                data = self.codec.encode_block(block.id, data)
-            yield ('data', data)
-        if not prev_block or block.refcnt != prev_block.refcnt:
-            yield 'refcnt', block.refcnt
-        if not prev_block or block.type != prev_block.type:
-            yield 'type', block.type
+        if DEBUG:
+            _debug('delete_block %s', block)
+        self._pending[block.id] = None
+        self._pending_new.discard(block.id)
+
+    def _encode_block_data(self, block):
+        if not block.has_data:
+            return b''
+        return block.encode_data(self.codec)
+
+    def _add_pending(self, block, data):
+        if data is None:
+            # Retain (not yet written) data of earlier change, if any
+            old = self._pending.get(block.id)
+            if old is not None:
+                data = old[1]
+        self._pending[block.id] = (block.id, data, block.refcnt, block.type)
 
     def flush_block(self, block):
-        params = []
-        fields = []
-        for k, v in self._get_changed_block_fields(block):
-            fields.append('%s=?' % k)
-            params.append(v)
-        params.append(block.id)
-        fields = ','.join(fields)
-        if len(params) > 1:
-            self._get_execute_result(
-                'UPDATE blocks SET %s WHERE id=?' % fields, tuple(params))
-        return len(params) - 1
+        if block.id in self._pending and self._pending[block.id] is None:
+            return 0  # deleted; do not resurrect it
+        prev_block = block.stored
+        ops = 0
+        data = None
+        if block.has_data != prev_block.has_data:
+            data = self._encode_block_data(block)
+            ops += 1
+        if block.refcnt != prev_block.refcnt:
+            ops += 1
+        if block.type != prev_block.type:
+            ops += 1
+        if ops:
+            self._add_pending(block, data)
+        return ops
 
     def flush_done(self):
+        pending = self._pending
+        if pending:
+            self._pending = {}
+            new = self._pending_new
+            self._pending_new = set()
+            self.conn.executemany('DELETE FROM blocks WHERE id=?',
+                                  ((k,) for k, v in pending.items()
+                                   if v is None))
+            bulk = len(new) >= self.bulk_insert_size
+            if bulk:
+                self.conn.execute('DROP INDEX IF EXISTS block_type;')
+            # Plain insert fails if the block already exists
+            self.conn.executemany(self._insert_sql,
+                                  (pending[k] for k in new))
+            if bulk:
+                self.conn.execute(self._index_sql)
+            self.conn.executemany(self._upsert_sql,
+                                  (v for k, v in pending.items()
+                                   if v is not None and k not in new))
         self.conn.commit()
+        storage.StorageBackend.flush_done(self)
 
     def get_block_by_id(self, st, block_id):
-        _debug('get_block_by_id %s', block_id)
-        r = self._get_execute_result(
-            'SELECT data,refcnt,type FROM blocks WHERE id=?', (block_id,))
-        if len(r) == 0:
-            return
-        assert len(r) == 1
-        r = list(r[0])
-        block_data, block_refcnt, block_type = r
-        block_data = self.codec.decode_block(block_id, block_data)
-        b = storage.StoredBlock(st, block_id, refcnt=block_refcnt, data=block_data,
-                                type=block_type)
+        if DEBUG:
+            _debug('get_block_by_id %s', block_id)
+        p = self._pending.get(block_id)
+        if p is None and block_id in self._pending:
+            return  # deleted
+        if p is not None and p[1] is not None:
+            (_, block_data, block_refcnt, block_type) = p
+        else:
+            r = self.conn.execute(
+                'SELECT data,refcnt,type FROM blocks WHERE id=?',
+                (block_id,)).fetchone()
+            if r is None:
+                assert p is None
+                return
+            block_data, block_refcnt, block_type = r
+            if p is not None:
+                (_, _, block_refcnt, block_type) = p
+        b = storage.StoredBlock(st, block_id, refcnt=block_refcnt,
+                                type=block_type,
+                                encoded_data=block_data or None)
         return b
 
     def get_block_id_by_name(self, n):
-        _debug('get_block_id_by_name %s', n)
-        r = self._get_execute_result(
-            'SELECT id FROM blocknames WHERE name=?', (n,))
-        if len(r) == 0:
-            return
-        assert len(r) == 1
-        return r[0][0]
+        if DEBUG:
+            _debug('get_block_id_by_name %s', n)
+        r = self.conn.execute(
+            'SELECT id FROM blocknames WHERE name=?', (n,)).fetchone()
+        if r is not None:
+            return r[0]
 
     def get_bytes_available(self):
+        return self._get_cached('bytes_available',
+                                self._get_bytes_available)
+
+    def _get_bytes_available(self):
         if self.filename == ':memory:':
             return psutil.virtual_memory().available
         return psutil.disk_usage(self.filename).free
 
     def get_bytes_used(self):
-        r1 = self._get_execute_result('PRAGMA page_count;')
-        r2 = self._get_execute_result('PRAGMA page_size;')
-        return r1[0][0] * r2[0][0]
+        return self._get_cached('bytes_used', self._get_bytes_used)
+
+    def _get_bytes_used(self):
+        (page_count,) = self.conn.execute('PRAGMA page_count;').fetchone()
+        (page_size,) = self.conn.execute('PRAGMA page_size;').fetchone()
+        return page_count * page_size
 
     def set_block_name(self, block_id, n):
         assert n
-        _debug('set_block_name_raw %s %s', block_id, n)
-        self._get_execute_result(
-            'DELETE FROM blocknames WHERE name=?', (n,))
+        if DEBUG:
+            _debug('set_block_name_raw %s %s', block_id, n)
         if block_id:
-            self._get_execute_result(
-                'INSERT INTO blocknames VALUES (?, ?)', (n, block_id))
+            self.conn.execute('INSERT OR REPLACE INTO blocknames VALUES (?, ?)',
+                              (n, block_id))
+        else:
+            self.conn.execute('DELETE FROM blocknames WHERE name=?', (n,))
 
     def store_block(self, block):
-        _debug('store_block %s', block)
-        assert self.get_block_by_id(block.parent, block.id) is None
-        fields = ['id']
-        params = [block.id]
-        for k, v in self._get_changed_block_fields(block):
-            fields.append(k)
-            params.append(v)
-        fields = ', '.join(fields)
-        qs = ', '.join(['?'] * len(params))
-        self._get_execute_result(
-            'INSERT INTO blocks (%s) VALUES (%s)' % (fields, qs), tuple(params))
+        if DEBUG:
+            _debug('store_block %s', block)
+        # Existence is checked by the database in flush_done
+        if block.id in self._pending:
+            assert self._pending[block.id] is None
+        else:
+            self._pending_new.add(block.id)
+        self._add_pending(block, self._encode_block_data(block))
 
 
 class SQLiteStorage(storage.Storage):
@@ -48,6 +48,11 @@ if __name__ == '__main__':
             o.add(i)
         return o
 
+    def _insert_many(cl):
+        o = cl(_hasher, n=TEST_DATA_ITEMS)
+        o.add_many(range(TEST_DATA_ITEMS))
+        return o
+
     def _check(cl):
         o = _insert(cl)
         for i in range(TEST_DATA_CHECKS):
@@ -55,11 +60,14 @@ if __name__ == '__main__':
 
     l = []
     for cl in [bloom.BigIntBloom, bloom.IntArrayBloom]:
-        def _insert1():
+        def _insert1(cl=cl):
             _insert(cl)
-        def _check1():
+        def _insert_many1(cl=cl):
+            _insert_many(cl)
+        def _check1(cl=cl):
             _check(cl)
         l.append(('%s insert' % cl.__name__, _insert1))
+        l.append(('%s insert_many' % cl.__name__, _insert_many1))
         l.append(('%s insert+check' % cl.__name__, _check1))
 
     ms.perf.testList(l, maxtime=0.3)
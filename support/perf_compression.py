@@ -27,10 +27,18 @@ free.
 
 """
 
-import lz4  # pip install lz4
-import ms.perf
 import os
 
+import lz4.block  # pip install lz4
+import ms.perf
+
+if __name__ == '__main__':
+    global __package__
+    if __package__ is None:
+        import python3fuckup
+        __package__ = python3fuckup.get_package(__file__, 1)
+    import storage
+
 text10 = b'1234567890'
 text100k = text10 * 10000
 assert len(text100k) == 100000
@@ -38,35 +46,40 @@ garbage100k = os.urandom(len(text100k))
 
 
 def test_lz4_1():
-    lz4.compressHC(text10)
+    lz4.block.compress(text10, mode='high_compression')
 
 
 def test_lz4_2():
-    lz4.compressHC(text100k)
+    lz4.block.compress(text100k, mode='high_compression')
 
-compressed100k = lz4.compressHC(text100k)
+compressed100k = lz4.block.compress(text100k, mode='high_compression')
 
 print('text100k compressed length', len(compressed100k))
 
 
 def test_lz4_3():
-    s = lz4.loads(compressed100k)
+    s = lz4.block.decompress(compressed100k)
     #assert len(s) == len(text100k)
 
 
 def test_lz4_4():
-    lz4.compressHC(garbage100k)
+    lz4.block.compress(garbage100k, mode='high_compression')
 
 
 def test_lz4_4_2():
-    lz4.compress(garbage100k)
+    lz4.block.compress(garbage100k, mode='fast', acceleration=1)
+
+
+def test_lz4_4_3():
+    storage._is_compressible(garbage100k)
 
 
-compressedgarbage100k = lz4.compressHC(garbage100k)
+compressedgarbage100k = lz4.block.compress(garbage100k,
+                                           mode='high_compression')
 
 
 def test_lz4_5():
-    s = lz4.loads(compressedgarbage100k)
+    s = lz4.block.decompress(compressedgarbage100k)
     #assert len(s) == len(text100k)
 
 print('garbage100k compressed length', len(compressedgarbage100k))
@@ -76,5 +89,6 @@ ms.perf.testList([['lz4 t 10', test_lz4_1],
                   ['lz4 t 100k (d)', test_lz4_3],
                   ['lz4 g 100k HC', test_lz4_4],
                   ['lz4 g 100k', test_lz4_4_2],
+                  ['lz4 g 100k (guess)', test_lz4_4_3],
                   ['lz4 g 100k (d)', test_lz4_5]],
                  maxtime=0.1)
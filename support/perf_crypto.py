@@ -37,7 +37,8 @@ fernet 100k           :    1189.3112/sec [95.9ms] (840.82us/call)
 => Fernet seems insanely slow, aes gcm is the winner for simple
 conf+auth, and raw sha256 seems to work fine for what we want to do
 (300+MB/s on single core). 32-bit Murmurhash3 is virtually free (6
-GB/s on single core).
+GB/s on single core). xxh3 (if xxhash is installed) should be faster
+still, but the btree name hashes are mmh3 and part of the stored data.
 
 As a matter of fact, if we want to ensure 'correct' data coming out,
 aes gcm is cheaper check than sha256 of the data! Therefore, ENCRYPT
@@ -57,13 +58,19 @@ import os
 
 from cryptography.fernet import Fernet  # pip install cryptography
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import cmac, hashes, padding
+from cryptography.hazmat.primitives import cmac, hashes
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
 import mmh3  # pip install murmurhash3
 import ms.perf
 
+try:
+    import xxhash  # pip install xxhash
+except ImportError:
+    xxhash = None
+
 text10 = b'1234567890'
 text100k = text10 * 10000
 assert len(text100k) == 100000
@@ -73,6 +80,16 @@ def test_mmh(s):
     mmh3.hash64(s)
 
 
+def test_xxh3(s):
+    xxhash.xxh3_64_intdigest(s)
+
+
+def test_xxh3_128(s):
+    # two independent 64-bit hashes out of single call
+    h = xxhash.xxh3_128_intdigest(s)
+    return (h >> 64, h & ((1 << 64) - 1))
+
+
 password = b'password'
 salt = os.urandom(16)
 kdf = PBKDF2HMAC(algorithm=hashes.SHA256(),
@@ -89,33 +106,27 @@ _default_backend = default_backend()
 
 
 def test_sha256(s):
+    # What block id calculation used before util.blake2b
+    hashlib.sha256(s).digest()
+
+
+def test_hazmat_sha256(s):
     d = hashes.Hash(_sha256, backend=_default_backend)
     d.update(s)
     d.finalize()
 
 
-def test_hashlib_sha256(s):
-    h = hashlib.sha256()
-    h.update(s)
-    h.digest()
-
-_sha512 = hashes.SHA256()
-
-
 def test_sha512(s):
-    d = hashes.Hash(_sha256, backend=_default_backend)
-    d.update(s)
-    d.finalize()
+    hashlib.sha512(s).digest()
 
 iv = os.urandom(16)
-cipher = Cipher(algorithms.AES(rawkey), modes.CBC(iv),
+# CTR needs no padding (unlike e.g. CBC); storage itself uses GCM
+cipher = Cipher(algorithms.AES(rawkey), modes.CTR(iv),
                 backend=_default_backend)
 
 
 def test_aes(s):
     encryptor = cipher.encryptor()
-    padder = padding.PKCS7(128).padder()
-    s = padder.update(s) + padder.finalize()
     r = encryptor.update(s) + encryptor.finalize()
 
 cipher_gcm = Cipher(algorithms.AES(rawkey), modes.GCM(iv),
@@ -146,20 +157,35 @@ def test_aes_gcm_full(s):
     r = encryptor.update(s) + encryptor.finalize()
 
 
+aesgcm = AESGCM(rawkey)
+
+
+def test_aes_gcm_aead(s):
+    # What storage.ConfidentialBlockCodec uses
+    iv_new = os.urandom(16)
+    aesgcm.encrypt(iv_new, s, None)
+
+
 def test_fernet(s):
     f.encrypt(s)
 
 
+tests = [('mmh3', test_mmh),
+         ('aes ctr', test_aes),
+         ('aes cmac', test_aes_cmac),
+         ('aes gcm', test_aes_gcm),
+         ('aes gcm full', test_aes_gcm_full),
+         ('aes gcm aead', test_aes_gcm_aead),
+         ('sha 256', test_sha256),
+         ('sha 256 (hazmat)', test_hazmat_sha256),
+         ('sha 512', test_sha512),
+         ('fernet', test_fernet)]
+if xxhash is not None:
+    tests[1:1] = [('xxh3', test_xxh3),
+                  ('xxh3 128', test_xxh3_128)]
+
 l = []
-for (label, fun) in [('mmh3', test_mmh),
-                     ('aes', test_aes),
-                     ('aes cmac', test_aes_cmac),
-                     ('aes gcm', test_aes_gcm),
-                     ('aes gcm full', test_aes_gcm_full),
-                     ('sha 256', test_sha256),
-                     ('sha 256 (hashlib)', test_hashlib_sha256),
-                     ('sha 512', test_sha512),
-                     ('fernet', test_fernet)]:
+for (label, fun) in tests:
     def _foo1(fun=fun):
         fun(text10)
 
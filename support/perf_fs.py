@@ -20,26 +20,126 @@ the 'official' performance figures with.
 """
 
 import argparse
+import ctypes
+import ctypes.util
+import mmap
 import os
 import os.path
+import shutil
+import stat
 import subprocess
 
 _support_dir = os.path.dirname(__file__)
 _test_fs = os.path.join(_support_dir, '..', 'test_fs.py')
 
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+# umount2 on Linux, unmount on OS X; both take (path, flags)
+_umount = getattr(_libc, 'umount2', None) or getattr(_libc, 'unmount', None)
+
+
+def umount(mountpoint):
+    # Direct syscall if we can (which may require privileges), and
+    # only if that fails, umount binary
+    if _umount is not None and not _umount(os.fsencode(mountpoint), 0):
+        return
+    subprocess.call(['umount', mountpoint], stderr=subprocess.DEVNULL)
+
+
+_arg_parser = None
+
 
 def open_fs(args):
+    global _arg_parser
+    if _arg_parser is None:
+        import test_fs
+        _arg_parser = test_fs.argument_parser()
+    parsed_args = _arg_parser.parse_args(args)
+    # Popen does not involve shell (and uses vfork/posix_spawn if it can)
     return (subprocess.Popen([_test_fs] + list(args), stdout=2),
-            args)
+            parsed_args)
 
 
-def close_fs(t):
-    import test_fs
+def copy_file(src, dst, buf=bytearray(1 << 20)):
+    """Copy src to dst (dd if=src of=dst bs=1M), without process in
+    between so that the filesystem is what gets timed."""
+    bufs = [buf]
+    mv = memoryview(buf)
+    sfd = os.open(src, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+    try:
+        dfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                      getattr(os, 'O_CLOEXEC', 0), 0o644)
+        try:
+            while True:
+                n = os.readv(sfd, bufs)
+                if not n:
+                    break
+                ofs = 0
+                while ofs < n:
+                    ofs += os.write(dfd, mv[ofs:n])
+        finally:
+            os.close(dfd)
+    finally:
+        os.close(sfd)
+
+
+def copy_file_mmap(src, dst, chunk=16 << 20):
+    """Copy (large) src to dst by writing directly from mmap of src;
+    this avoids the read() copy to userspace buffer."""
+    sfd = os.open(src, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+    try:
+        mm = mmap.mmap(sfd, 0, prot=mmap.PROT_READ)
+    finally:
+        os.close(sfd)
+    with mm:
+        if hasattr(mm, 'madvise'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        mv = memoryview(mm)
+        try:
+            dfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                          getattr(os, 'O_CLOEXEC', 0), 0o644)
+            try:
+                ofs = 0
+                n = len(mv)
+                while ofs < n:
+                    ofs += os.write(dfd, mv[ofs:ofs + chunk])
+            finally:
+                os.close(dfd)
+        finally:
+            mv.release()
+
+
+def copy_tree(src, dst):
+    """Copy directory tree src to within dst (rsync -a src dst/), sans
+    ownership and timestamps."""
+    dst = os.path.join(dst, os.path.basename(src.rstrip('/')))
+    os.mkdir(dst)
+    for e in os.scandir(src):
+        if e.is_dir(follow_symlinks=False):
+            copy_tree(e.path, dst)
+        elif e.is_file(follow_symlinks=False):
+            copy_file(e.path, os.path.join(dst, e.name))
+
+
+def read_tree(root, buf=bytearray(1 << 20)):
+    """Read every file under root (find root -type f | xargs cat), but
+    without spawning a process per a bunch of files."""
+    bufs = [buf]
+    for e in os.scandir(root):
+        if e.is_dir(follow_symlinks=False):
+            read_tree(e.path, buf)
+        elif e.is_file(follow_symlinks=False):
+            fd = os.open(e.path, os.O_RDONLY)
+            try:
+                while os.readv(fd, bufs):
+                    pass
+            finally:
+                os.close(fd)
+
 
+def close_fs(t):
     (p, args) = t
-    args = test_fs.argument_parser().parse_args(args)
     try:
-        subprocess.call(['umount', args.mountpoint], stderr=subprocess.DEVNULL)
+        umount(args.mountpoint)
     except:
         pass
     try:
@@ -62,7 +162,7 @@ if __name__ == '__main__':
 
     import time
 
-    read_cmd = 'find /tmp/x -type f | xargs cat > /dev/null'
+    read_root = '/tmp/x'
     tests = []
     # tests.append(('In-memory dict', None, '', [])), # n/a really
     if True:
@@ -94,30 +194,36 @@ if __name__ == '__main__':
         tests = [tests[args.test]]
     for desc, backend_type, backend, backend_options in tests:
         print(f'# {desc}')
-        for write_cmd, units, unit_type in [
-                ('dd "if=/Volumes/ulko/share/2/software/unix/2015-09-24-raspbian-jessie.img" of=/tmp/x/foo.dat bs=1024000',
+        for write_desc, write_fun, units, unit_type in [
+                ('dd "if=/Volumes/ulko/share/2/software/unix/2015-09-24-raspbian-jessie.img" of=/tmp/x/foo.dat bs=1M',
+                 lambda: copy_file_mmap('/Volumes/ulko/share/2/software/unix/2015-09-24-raspbian-jessie.img', '/tmp/x/foo.dat'),
                  4325, 'megabyte'),  # 1 file :p
                 ('rsync -a /Users/mstenber/share/1/Maildir/.Junk /tmp/x/',
+                 lambda: copy_tree('/Users/mstenber/share/1/Maildir/.Junk', '/tmp/x/'),
                  56711, 'file'),  # 1082MB
         ]:
             print(f'## Write {units} {unit_type}s')
 
-            print(f'Command: {write_cmd}')
+            print(f'Equivalent command: {write_desc}')
             if backend:
-                if os.path.isfile(backend):
+                try:
+                    mode = os.stat(backend).st_mode
+                except FileNotFoundError:
+                    mode = 0
+                if stat.S_ISREG(mode):
                     os.unlink(backend)
-                elif os.path.isdir(backend):
-                    os.system('rm -rf %s' % backend)
+                elif stat.S_ISDIR(mode):
+                    shutil.rmtree(backend)
             args = []
             if backend:
-                args.extend(['-f', backend])
+                args.extend(['-f', backend, '--bench'])
                 args.extend(backend_options)
             t = open_fs(args)
             time.sleep(1)
-            start_time = time.time()
-            os.system(write_cmd)
+            start_time = time.perf_counter_ns()
+            write_fun()
             close_fs(t)
-            write_time = time.time() - start_time
+            write_time = (time.perf_counter_ns() - start_time) * 1e-9
             cnt = units // write_time
             print()
             print(f'Took {write_time} seconds')
@@ -126,13 +232,13 @@ if __name__ == '__main__':
 
             if backend:
                 print(f'## Read it back')
-                print(f'Command: {read_cmd}')
+                print(f'Reading all files in {read_root}')
                 t = open_fs(args)
                 time.sleep(1)
-                start_time = time.time()
-                os.system(read_cmd)
+                start_time = time.perf_counter_ns()
+                read_tree(read_root)
                 close_fs(t)
-                read_time = time.time() - start_time
+                read_time = (time.perf_counter_ns() - start_time) * 1e-9
                 cnt = units // read_time
                 print()
                 print(f'Took {read_time} seconds')
@@ -26,6 +26,24 @@ import ms.perf
 def test_nop():
     pass
 
+
+def loop_cost(fun, n=1000000):
+    """Return per-call cost of fun in ns, less the loop (and call of
+    test_nop) overhead which dominates the testList figures above."""
+    def _run(fun):
+        t0 = time.perf_counter_ns()
+        for _ in range(n):
+            fun()
+        return time.perf_counter_ns() - t0
+    return (_run(fun) - _run(test_nop)) / n
+
 ms.perf.testList([['nop', test_nop],
                   ['time.time', time.time],
+                  ['time.monotonic', time.monotonic],
+                  ['time.perf_counter_ns', time.perf_counter_ns],
                   ], maxtime=0.1)
+
+for label, fun in [('time.time', time.time),
+                   ('time.monotonic', time.monotonic),
+                   ('time.perf_counter_ns', time.perf_counter_ns)]:
+    print('%-20s: %.1fns/call (net)' % (label, loop_cost(fun)))
@@ -56,3 +56,16 @@ def test_bloom_huge(bloom_class):
     for i in range(20):
         b.add(i)
     assert b.count == float('inf')
+
+
+def test_bloom_add_many(bloom_class):
+    b = bloom_class(_nophasher, n=10)
+    b2 = bloom_class(_nophasher, n=10)
+    l = [1, 3, 3, 42, 12345]
+    for i in l:
+        b.add(i)
+    b2.add_many(l)
+    assert b.value == b2.value
+    assert b.count == b2.count
+    assert b2.has(42)
+    assert not b2.has(2)
@@ -25,6 +25,11 @@ import btree
 
 _debug = logging.getLogger(__name__).debug
 
+# Fixed seed so that failures are reproducible
+_random = random.Random(42)
+
+_NAMES = [b'%04d' % i for i in range(1000)]
+
 
 class NoHashLeafNode(btree.LeafNode):
     name_hash_size = 0
@@ -44,6 +49,8 @@ def test_simple():
     assert tn.search_prev_or_eq(n3) == n2
     assert tn.search(n3) == None
     assert tn.search(n2) == n2
+    assert tn.search_key(NoHashLeafNode.key_for_name(b'bar.txt')) == n2
+    assert btree.LeafNode.key_for_name(b'x') == btree.LeafNode(b'x').key
 
     assert tn.children == [n2, n1]
     tn.remove_child(n2)
@@ -62,8 +69,8 @@ def test_simple():
 
 class LeafierTreeNode(btree.TreeNode):
     maximum_size = 2048
-    minimum_size = maximum_size * 1 / 4
-    has_spares_size = maximum_size / 2
+    minimum_size = maximum_size // 4
+    has_spares_size = maximum_size // 2
 
 
 @pytest.mark.run(order=-1)  # quite slow :p
@@ -76,12 +83,12 @@ def test_large_tree(hashleaf):
         # all rebalancing options NOT covered: 100
         # all rebalancing options covered: 1000
         # (oh well, few seconds of CPU, who cares?)
-        name = b'%04d' % i
+        name = _NAMES[i]
         n = cl(name)
         n.i = i
         nodes.append(n)
     last_leaf_name = name
-    random.shuffle(nodes)
+    _random.shuffle(nodes)
     for i, n in enumerate(nodes):
         _debug('add #%d: %s', i, n)
         root.add_to_tree(n)
@@ -108,7 +115,7 @@ def test_large_tree(hashleaf):
 
     # Randomly remove nodes from it; the tree should stay fully functional to
     # the bitter end.
-    random.shuffle(nodes)
+    _random.shuffle(nodes)
     for i, n in enumerate(nodes):
         _debug('remove #%d: %s', i, n)
         n2 = cl(n.name)
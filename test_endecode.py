@@ -33,6 +33,11 @@ def test_uint32(v):
     assert v == v2
 
 
+def test_uint_byteorder():
+    assert Encoder().encode_uint32(0x01020304).value == b'\x01\x02\x03\x04'
+    assert Encoder().encode_uint64(0x0102).value == b'\0' * 6 + b'\x01\x02'
+
+
 @pytest.mark.parametrize('v', [-1234678458, -73, -1, 0, 1, 3, 2362436])
 def test_int(v):
     v2 = Decoder(Encoder().encode_int(v).value).decode_int()
@@ -45,7 +50,7 @@ def test_cbytes(v):
     assert v == v2
 
 
-@pytest.mark.parametrize('v', [b'foob', b'foo', b'fo', b'f', b''])
+@pytest.mark.parametrize('v', [b'foob', b'foo', b'fo', b'f', b'', b'\xfb\xff'])
 def test_b64(v):
     v2 = Decoder(Encoder().encode_base64url(v).value).decode_base64url()
     assert v == v2
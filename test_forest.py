@@ -31,8 +31,8 @@ _debug = logging.getLogger(__name__).debug
 
 class LeafierDirectoryTreeNode(forest.DirectoryTreeNode):
     maximum_size = 2048
-    minimum_size = maximum_size * 1 / 4
-    has_spares_size = maximum_size / 2
+    minimum_size = maximum_size // 4
+    has_spares_size = maximum_size // 2
 
 
 def testforest():
@@ -64,7 +64,7 @@ def testforest():
     del d['st_atime_ns']
     del d['st_ctime_ns']
     del d['st_mtime_ns']
-    assert d == dict(foo=42, st_mode=stat.S_IFREG)
+    assert d == {'foo': 42, 'st_mode': stat.S_IFREG}
     assert not f2.root.node.dirty
 
     # add a directory
@@ -102,8 +102,10 @@ def test_deepforest():
 
     f2 = forest.Forest(storage)
     parent_inode = f2.root
+    debug = logging.getLogger(__name__).isEnabledFor(logging.DEBUG)
     for i in range(test_depth):
-        _debug('iteration #%d/%d', i + 1, test_depth)
+        if debug:
+            _debug('iteration #%d/%d', i + 1, test_depth)
         parent_inode = f2.lookup(parent_inode, b'dir')
     assert parent_inode.leaf_node.data['foo'] == 42
 
@@ -112,17 +114,81 @@ def test_wideforest():
     storage = DictStorage()
     f = forest.Forest(storage)
     f.directory_node_class = LeafierDirectoryTreeNode
-    test_count = 100
-    for i in range(test_count):
-        inode = f.create_dir(f.root, name=b'foo%d' % i)
+    names = [b'foo%d' % i for i in range(100)]
+    for name in names:
+        inode = f.create_dir(f.root, name=name)
     f.flush()
 
     f2 = forest.Forest(storage)
-    for i in range(test_count):
-        inode = f2.lookup(f2.root, b'foo%d' % i)
+    for name in names:
+        inode = f2.lookup(f2.root, name)
         assert inode
 
 
+def test_forest_batch():
+    storage = DictStorage()
+    f = forest.Forest(storage)
+
+    # No flush requested -> no flush at the end either
+    with f.batch():
+        f.create_dir(f.root, b'foo').deref()
+    assert storage.get_block_id_by_name(f.content_name) is None
+
+    # Nested batches flush only when the outermost one exits
+    with f.batch():
+        with f.batch():
+            f.flush()
+        assert storage.get_block_id_by_name(f.content_name) is None
+    assert storage.get_block_id_by_name(f.content_name)
+    assert not f.flush()
+
+    # Exception drops the deferred flush, and does not leak it into
+    # the next batch either
+    bid = storage.get_block_id_by_name(f.content_name)
+    with pytest.raises(RuntimeError):
+        with f.batch():
+            f.create_dir(f.root, b'bar').deref()
+            f.flush()
+            raise RuntimeError
+    assert not f._batch_depth
+    with f.batch():
+        pass
+    assert storage.get_block_id_by_name(f.content_name) == bid
+
+
+def test_reference_set_dict():
+    d = forest._ReferenceSetDict()
+    s = d[b'foo']
+    assert not s
+    del d[b'foo']
+    assert b'foo' not in d
+    assert d[b'bar'] is s
+
+
+def test_name_cache():
+    storage = DictStorage()
+    f = forest.Forest(storage)
+    f.create_dir(f.root, b'foo').deref()
+    n = f.root.node.search_name(b'foo')
+    assert n
+    assert f.root.node.search_name(b'foo') is n
+    f.unlink(f.root, b'foo')
+    assert not f.root.node.search_name(b'foo')
+    f.create_dir(f.root, b'foo').deref()
+    n2 = f.root.node.search_name(b'foo')
+    assert n2 and n2 is not n
+    f.flush()
+    # Flush may unload the tree; cached leaves must not outlive it
+    n3 = f.root.node.search_name(b'foo')
+    assert n3.root is f.root.node
+    assert f.root.node.search_name(b'foo') is n3
+    # A lookup caches the other leaves it passed by as well
+    f.create_dir(f.root, b'bar').deref()
+    f.flush()
+    assert not f.root.node.search_name(b'baz')
+    assert f.root.node._name_cache[b'bar'] is f.root.node.search_name(b'bar')
+
+
 @pytest.mark.parametrize('iter', [0, 1])
 def test_merge3_file(iter):
     remote_name = b'remote'
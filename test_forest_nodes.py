@@ -39,7 +39,7 @@ def test_block_id_referrer_with_forest():
         block_id_references = collections.defaultdict(set)
 
         def nodes(self, key):
-            return set(x.node for x in self.block_id_references[key])
+            return {x.node for x in self.block_id_references[key]}
     df = DummyForest()
 
     class DummyNode(forest_nodes.BlockIdReferrerMixin):
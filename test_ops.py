@@ -184,7 +184,7 @@ def attr_equal(a1, a2):
 
 def test_dir(oc):
     fd = oc.ops.opendir(oc.inodes[b'root_dir'], oc.rctx_root)
-    l = list(x[0] for x in oc.ops.readdir(fd, 0))
+    l = [x[0] for x in oc.ops.readdir(fd, 0)]
     assert l == [b'root_file_in']
     oc.ops.releasedir(fd)
 
@@ -22,6 +22,7 @@ import sqlite3
 import tempfile
 import unittest
 
+import cbor2
 import cryptography.exceptions
 import pytest
 
@@ -231,6 +232,22 @@ class ConfidentialBlockCodecTests(unittest.TestCase):
             self.cbc.decode_block(self.block_id, b'x')
 
 
+def test_confidential_typeencoding():
+    block_id = b'12345678901234567890123456789012'
+    t = st.TypedBlockCodec(st.ConfidentialBlockCodec(b'assword'))
+    s = t.encode_block(block_id, (7, b'42'))
+    assert t.decode_block(block_id, s) == (7, b'42')
+
+    # type is authenticated
+    s2 = s[:4] + bytes([6]) + s[5:]
+    with pytest.raises(cryptography.exceptions.InvalidTag):
+        t.decode_block(block_id, s2)
+
+    # older format (type within encrypted data) is still readable
+    s3 = t.codec.encode_block(block_id, bytes([7]) + b'42')
+    assert t.decode_block(block_id, s3) == (7, b'42')
+
+
 def test_typeencoding():
     t = st.TypedBlockCodec(st.NopBlockCodec())
     s = t.encode_block(None, (7, b'42'))
@@ -254,10 +271,47 @@ def test_compression_fail():
     assert c.decode_block(None, s) == (7, plaintext)
 
 
+def test_compression_incompressible():
+    c = st.CompressingTypedBlockCodec(st.NopBlockCodec())
+    assert st._is_compressible(b'1234567890' * 10000)
+    plaintext = os.urandom(100000)
+    assert not st._is_compressible(plaintext)
+    s = c.encode_block(None, (7, plaintext))
+    assert s == bytes([7]) + plaintext
+    assert c.decode_block(None, s) == (7, plaintext)
+
+
 def test_storage_backends(backend):
     _prod_storage(st.Storage(backend=backend))
 
 
+def test_storage_backend_cached(backend):
+    calls = []
+
+    def _fun():
+        calls.append(1)
+        return len(calls)
+    assert backend._get_cached('x', _fun) == 1
+    assert backend._get_cached('x', _fun) == 1
+    backend.flush_done()
+    assert backend._get_cached('x', _fun) == 2
+    assert backend._get_cached('y', _fun, max_age=-1) == 3
+    assert backend._get_cached('y', _fun, max_age=-1) == 4
+    assert backend.get_bytes_available() > 0
+
+
+def test_storage_backend_get_blocks_by_ids(backend):
+    s = st.Storage(backend=backend)
+    s.store_block(b'b', b'bar')
+    s.store_block(b'a', b'foo')
+    s.flush()
+    s.store_block(b'c', b'baz')
+    bl = list(backend.get_blocks_by_ids(s, [b'c', b'x', b'b', b'a']))
+    assert sorted((b.id, b.data) for b in bl) == [(b'a', b'foo'),
+                                                  (b'b', b'bar'),
+                                                  (b'c', b'baz')]
+
+
 def test_storage_wrapped(storage):
     _prod_storage(storage)
 
@@ -278,6 +332,176 @@ def test_sqlitestorage_available_file():
         assert s.get_bytes_available()
 
 
+class _CountingBlockCodec(st.NopBlockCodec):
+    decoded = 0
+    encoded = 0
+
+    def decode_block(self, block_id, block_data):
+        self.decoded += 1
+        return block_data
+
+    def encode_block(self, block_id, block_data):
+        self.encoded += 1
+        return block_data
+
+
+@pytest.mark.parametrize('backend_class', [stsql.SQLiteStorageBackend,
+                                           stlm.LMDBStorageBackend])
+def test_storage_refcnt_no_decode(backend_class):
+    codec = _CountingBlockCodec()
+    s = st.Storage(backend=backend_class(codec=codec))
+    s.store_block(b'foo', b'bar')
+    s.flush()
+    s.refer_block(b'foo')
+    assert s.flush()
+    s.release_block(b'foo')
+    assert s.flush()
+    assert not codec.decoded
+    assert s.get_block_data_by_id(b'foo') == b'bar'
+    assert codec.decoded == 1
+
+
+@pytest.mark.parametrize('backend_class', [stsql.SQLiteStorageBackend,
+                                           stlm.LMDBStorageBackend])
+def test_storage_refcnt_no_reencode(backend_class):
+    codec = _CountingBlockCodec()
+    s = st.DelayedStorage(backend=backend_class(codec=codec))
+    s.store_block(b'foo', b'bar')
+    s.flush()
+    assert codec.encoded == 1
+    s.refer_block(b'foo')
+    assert s.flush()
+    s.release_block(b'foo')
+    assert s.flush()
+    assert codec.encoded == 1
+    assert s.get_block_data_by_id(b'foo') == b'bar'
+
+
+def test_sqlitestorage_pragma_profile():
+    be = stsql.SQLiteStorageBackend(pragma_profile='bench')
+    assert be._get_execute_result('PRAGMA cache_size;') == [(-65536,)]
+    assert be._get_execute_result('PRAGMA synchronous;') == [(1,)]
+    _prod_storage(st.Storage(backend=be))
+
+
+def test_lmdbstorage_readahead():
+    # Small (here, empty) database fits in memory -> readahead is fine
+    be = stlm.LMDBStorageBackend()
+    assert be.env.flags()['readahead']
+
+
+def test_lmdbstorage_batched_writes():
+    be = stlm.LMDBStorageBackend()
+    s = st.Storage(backend=be)
+    s.store_block(b'foo', b'bar')
+    with be.env.begin(db=be.block_db) as t:
+        assert t.get(b'foo') is None
+    assert s.get_block_data_by_id(b'foo') == b'bar'
+    s.flush()
+    assert not be._pending
+    with be.env.begin(db=be.block_db) as t:
+        assert t.get(b'foo')
+
+
+def test_sqlitestorage_batched_writes():
+    be = stsql.SQLiteStorageBackend()
+    s = st.Storage(backend=be)
+    s.store_block(b'foo', b'bar')
+    s.flush()
+    s.refer_block(b'foo')
+    assert s.flush() == 1
+    s.release_block(b'foo')
+    assert s.get_block_by_id(b'foo').refcnt == 1
+    s.release_block(b'foo')
+    assert s.get_block_by_id(b'foo') is None
+    assert be._get_execute_result('SELECT refcnt FROM blocks') == [(2,)]
+    s.flush()
+    assert not be._pending
+    assert be._get_execute_result('SELECT refcnt FROM blocks') == []
+
+
+def test_sqlitestorage_bulk_insert():
+    be = stsql.SQLiteStorageBackend()
+    be.bulk_insert_size = 2
+    s = st.Storage(backend=be)
+    s.store_block(b'foo', b'bar')
+    s.store_block(b'baz', b'bar')
+    s.flush()
+    q = "SELECT name FROM sqlite_master WHERE type='index'"
+    assert ('block_type',) in be._get_execute_result(q)
+    assert s.get_block_data_by_id(b'baz') == b'bar'
+    _prod_storage(s)
+
+
+def test_lmdbstorage_cbor_record():
+    be = stlm.LMDBStorageBackend()
+    s = st.Storage(backend=be)
+    with be.env.begin(db=be.block_db, write=True) as t:
+        t.put(b'foo', cbor2.dumps([b'bar', 2, const.BLOCK_TYPE_NORMAL]))
+    b = s.get_block_by_id(b'foo')
+    assert b.data == b'bar' and b.refcnt == 2
+    s.release_block(b'foo')
+    s.flush()
+    with be.env.begin(db=be.block_db) as t:
+        assert t.get(b'foo')[0] == stlm._record_version  # rewritten
+    assert s.get_block_by_id(b'foo').refcnt == 1
+
+
+def test_lmdbstorage_put_sorted():
+    be = stlm.LMDBStorageBackend()
+    with be.env.begin(db=be.block_db, write=True) as t:
+        with t.cursor() as c:
+            assert be._put_sorted(c, [(b'b', b'1'), (b'd', b'2')]) == 2
+            assert be._put_sorted(c, [(b'a', b'1'), (b'c', b'2'),
+                                      (b'd', b'3'), (b'e', b'4')]) == 4
+            assert be._put_sorted(c, [(b'a', b'x'), (b'f', b'5')],
+                                  overwrite=False) == 1
+        assert list(t.cursor()) == [(b'a', b'1'), (b'b', b'1'), (b'c', b'2'),
+                                    (b'd', b'3'), (b'e', b'4'), (b'f', b'5')]
+
+
+def test_storage_release_flush(storage):
+    storage.store_block(b'foo', b'bar')
+    storage.flush()
+    storage.refer_block(b'foo')
+    storage.release_block(b'foo')
+    storage.release_block(b'foo')
+    storage.flush()
+    assert storage.get_block_by_id(b'foo') is None
+
+
+@pytest.mark.parametrize('backend_class, exception', [
+    (stsql.SQLiteStorageBackend, sqlite3.IntegrityError),
+    (stlm.LMDBStorageBackend, AssertionError),
+])
+def test_storage_store_existing(backend_class, exception):
+    be = backend_class()
+    s = st.Storage(backend=be)
+    s.store_block(b'foo', b'bar')
+    s.flush()
+    be.store_block(st.StoredBlock(s, b'foo', data=b'bar', refcnt=1, type=0))
+    with pytest.raises(exception):
+        s.flush()
+
+
+def test_dictstorage_bytes_used():
+    s = st.DictStorage()
+    assert not s.get_bytes_used()
+    s.store_block(b'foo', b'bar')
+    s.flush()
+    used = s.get_bytes_used()
+    assert used == len(b'foo') + len(b'bar')
+    s.refer_block(b'foo')
+    assert s.backend.bid2block[b'foo'][0] == 1  # not flushed yet
+    s.flush()
+    assert s.backend.bid2block[b'foo'][0] == 2
+    assert s.get_bytes_used() == used
+    s.release_block(b'foo')
+    s.release_block(b'foo')
+    s.flush()
+    assert not s.get_bytes_used()
+
+
 _backends = {'sqlite': stsql.SQLiteStorageBackend,
              'dict': st.DictStorageBackend,
              'lmdb': stlm.LMDBStorageBackend,
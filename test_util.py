@@ -84,3 +84,10 @@ def test_getrecsizeof_tuple():
 def test_to_bytes():
     assert util.to_bytes(b'foo') == b'foo'
     assert util.to_bytes('foo') == b'foo'
+
+
+def test_blake2b():
+    assert len(util.blake2b(b'', b'foo')) == 32
+    assert util.blake2b(b'', 1, b'foo') == util.blake2b(b'', b'\x01foo')
+    assert util.blake2b(b'', b'foo') != util.blake2b(b'k', b'foo')
+    assert util.blake2b(b'k', b'foo') != util.blake2b(b'', b'k', b'foo')
@@ -18,26 +18,29 @@ Random utility things.
 
 """
 
-import collections
+import collections.abc
 import hashlib
 import logging
 import sys
 
-import cbor
+import cbor2
 
 from ms.lazy import lazy_property
 
 _debug = logging.getLogger(__name__).debug
 
 
-def sha256(*l):
-    """Convenience method to sha256 bunch of int/bytes.
+def blake2b(key, *l):
+    """Convenience method to 32-byte blake2b bunch of int/bytes.
+
+    Non-empty key is used as the blake2b key, which makes the result
+    a MAC in single pass (instead of hashing key as part of data).
 
     Integers are converted to bytes (TBD: should 'larger' ints be
     supported? in practise we want just type info which should be <=
     byte, and CBOR encoded raw bytes)
     """
-    h = hashlib.sha256()
+    h = hashlib.blake2b(digest_size=32, key=key)
     for s in l:
         if isinstance(s, int):
             s = bytes([s])
@@ -213,7 +216,7 @@ class CBORPickler:
         return d
 
     def dumps(self, o):
-        return cbor.dumps(self.get_external_dict(o))
+        return cbor2.dumps(self.get_external_dict(o))
 
     def get_internal_dict_items(self, o):
         for k in self.internal2external_dict.keys():
@@ -236,7 +239,7 @@ class CBORPickler:
             yield self.external2internal_dict[k], v
 
     def load_external_dict_to(self, d, o):
-        self.set_external_dict_to(cbor.loads(d), o)
+        self.set_external_dict_to(cbor2.loads(d), o)
         return o
 
     def set_external_dict_to(self, d, o):
@@ -267,7 +270,7 @@ def getrecsizeof(o, seen=None):
             c += getrecsizeof(v, seen)
     elif isinstance(o, str) or isinstance(o, bytes):
         pass
-    elif isinstance(o, collections.Iterable):
+    elif isinstance(o, collections.abc.Iterable):
         for e in o:
             c += getrecsizeof(e, seen)
     return c